@@ -1,9 +1,17 @@
+import base64
+import hashlib
 import json
+import marshal
 import os
 import re
+import signal
+import sys
+import tempfile
 import time
+import zlib
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import requests
 
 LOG_PATTERNS = {
@@ -51,166 +59,350 @@ LOG_PATTERNS = {
     "paniclog": re.compile(r"^(?P<ts>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}).*$"),
 }
 
-class Agent:
-    def __init__(self, cfg: Dict):
-        self.cfg = cfg
-        self.state_path = cfg.get("state_file", "./state.json")
-        self.state = self._load_state()
-        # In-memory correlation cache (not persisted across restarts)
-        self.qid_cache: Dict[str, Dict] = {}
-        self.qid_flush_seconds = int(self.cfg.get("qid_flush_seconds", 600))
-        self.max_qid_cache = int(self.cfg.get("max_qid_cache", 10000))
-        self.verbose = bool(self.cfg.get("verbose", False))
-        self._pending_sender = {"value": None, "ts": None}
-
-    def _norm_addr(self, v: Optional[str]) -> Optional[str]:
-        if not v:
-            return v
-        v = v.strip()
-        # if multiple addresses separated by whitespace or comma/semicolon, take the first
-        if ' ' in v:
-            v = v.split()[0]
-        if ',' in v:
-            v = v.split(',', 1)[0]
-        if ';' in v:
-            v = v.split(';', 1)[0]
-        # remove optional display name remnants and angle brackets
-        if v.startswith('<') and v.endswith('>'):
-            v = v[1:-1]
-        # remove trailing comma/semicolon
-        v = v.rstrip(',;')
+def norm_addr(v: Optional[str]) -> Optional[str]:
+    if not v:
         return v
+    v = v.strip()
+    # if multiple addresses separated by whitespace or comma/semicolon, take the first
+    if ' ' in v:
+        v = v.split()[0]
+    if ',' in v:
+        v = v.split(',', 1)[0]
+    if ';' in v:
+        v = v.split(';', 1)[0]
+    # remove optional display name remnants and angle brackets
+    if v.startswith('<') and v.endswith('>'):
+        v = v[1:-1]
+    # remove trailing comma/semicolon
+    v = v.rstrip(',;')
+    return v
 
-    def _load_state(self) -> Dict:
-        if os.path.exists(self.state_path):
-            with open(self.state_path, "r") as f:
-                return json.load(f)
-        return {"offsets": {}}
-
-    def _save_state(self):
-        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
-        with open(self.state_path, "w") as f:
-            json.dump(self.state, f)
-
-    def _parse_line(self, kind: str, line: str) -> Dict:
-        ts = datetime.utcnow()
-        sender = None
-        recipient = None
-        status = None
-        message = line.strip()
-        message_id = None
-        qid = None
-        meta: Dict[str, str] = {}
-        if kind == "mainlog":
-            # Completion line (flush trigger)
-            mc = LOG_PATTERNS["completed"].match(line)
-            if mc:
-                ts = datetime.strptime(mc.group("ts"), "%Y-%m-%d %H:%M:%S")
-                qid = mc.group("qid")
-                return {
-                    "qid": qid,
-                    "timestamp": ts,
-                    "completed": True,
-                    "kind": kind,
-                    "message": message,
-                }
-            m = LOG_PATTERNS["main_in"].match(line)
+def parse_line(kind: str, line: str, server_name: Optional[str]) -> Dict:
+    ts = datetime.utcnow()
+    sender = None
+    recipient = None
+    status = None
+    message = line.strip()
+    message_id = None
+    qid = None
+    meta: Dict[str, str] = {}
+    if kind == "mainlog":
+        # Completion line (flush trigger)
+        mc = LOG_PATTERNS["completed"].match(line)
+        if mc:
+            ts = datetime.strptime(mc.group("ts"), "%Y-%m-%d %H:%M:%S")
+            qid = mc.group("qid")
+            return {
+                "qid": qid,
+                "timestamp": ts,
+                "completed": True,
+                "kind": kind,
+                "message": message,
+            }
+        m = LOG_PATTERNS["main_in"].match(line)
+        if m:
+            ts = datetime.strptime(m.group("ts"), "%Y-%m-%d %H:%M:%S")
+            sender = m.group("sender")
+            qid = m.group("qid")
+            recipient = m.group("recipient") or recipient
+            message_id = m.group("msgid") or message_id
+            status = status or "received"
+            # enrich optional meta
+            for key, rx in ("rt", LOG_PATTERNS["rt"]), ("host", LOG_PATTERNS["host"]), ("tls", LOG_PATTERNS["tls"]), ("size", LOG_PATTERNS["size"]), ("reply", LOG_PATTERNS["reply"]):
+                mm = rx.match(line)
+                if mm:
+                    meta.update({k: v for k, v in mm.groupdict().items() if v})
+        else:
+            m = LOG_PATTERNS["main_out"].match(line)
             if m:
                 ts = datetime.strptime(m.group("ts"), "%Y-%m-%d %H:%M:%S")
-                sender = m.group("sender")
+                recipient = m.group("recipient")
                 qid = m.group("qid")
-                recipient = m.group("recipient") or recipient
-                message_id = m.group("msgid") or message_id
-                status = status or "received"
-                # enrich optional meta
+                status = status or "delivered"
                 for key, rx in ("rt", LOG_PATTERNS["rt"]), ("host", LOG_PATTERNS["host"]), ("tls", LOG_PATTERNS["tls"]), ("size", LOG_PATTERNS["size"]), ("reply", LOG_PATTERNS["reply"]):
                     mm = rx.match(line)
                     if mm:
                         meta.update({k: v for k, v in mm.groupdict().items() if v})
             else:
-                m = LOG_PATTERNS["main_out"].match(line)
+                m = LOG_PATTERNS["defer"].match(line)
                 if m:
                     ts = datetime.strptime(m.group("ts"), "%Y-%m-%d %H:%M:%S")
                     recipient = m.group("recipient")
                     qid = m.group("qid")
-                    status = status or "delivered"
-                    for key, rx in ("rt", LOG_PATTERNS["rt"]), ("host", LOG_PATTERNS["host"]), ("tls", LOG_PATTERNS["tls"]), ("size", LOG_PATTERNS["size"]), ("reply", LOG_PATTERNS["reply"]):
-                        mm = rx.match(line)
-                        if mm:
-                            meta.update({k: v for k, v in mm.groupdict().items() if v})
+                    status = "deferred"
+                    message = m.group("reason") or message
                 else:
-                    m = LOG_PATTERNS["defer"].match(line)
+                    m = LOG_PATTERNS["delivered_local"].match(line)
                     if m:
                         ts = datetime.strptime(m.group("ts"), "%Y-%m-%d %H:%M:%S")
                         recipient = m.group("recipient")
                         qid = m.group("qid")
-                        status = "deferred"
-                        message = m.group("reason") or message
+                        status = "accepted"
                     else:
-                        m = LOG_PATTERNS["delivered_local"].match(line)
+                        m = LOG_PATTERNS["warning"].match(line)
                         if m:
                             ts = datetime.strptime(m.group("ts"), "%Y-%m-%d %H:%M:%S")
                             recipient = m.group("recipient")
                             qid = m.group("qid")
-                            status = "accepted"
+                            status = "warning"
+                            message = m.group("subject") or message
                         else:
-                            m = LOG_PATTERNS["warning"].match(line)
+                            m = LOG_PATTERNS["sender_id"].match(line)
                             if m:
                                 ts = datetime.strptime(m.group("ts"), "%Y-%m-%d %H:%M:%S")
-                                recipient = m.group("recipient")
-                                qid = m.group("qid")
-                                status = "warning"
-                                message = m.group("subject") or message
+                                sender = m.group("sender")
+                                # qid pode não existir nessa linha
                             else:
-                                m = LOG_PATTERNS["sender_id"].match(line)
+                                m = LOG_PATTERNS["auth_failed"].match(line)
                                 if m:
                                     ts = datetime.strptime(m.group("ts"), "%Y-%m-%d %H:%M:%S")
-                                    sender = m.group("sender")
-                                    # qid pode não existir nessa linha
-                                else:
-                                    m = LOG_PATTERNS["auth_failed"].match(line)
-                                    if m:
-                                        ts = datetime.strptime(m.group("ts"), "%Y-%m-%d %H:%M:%S")
-                                        sender = m.group("user")
-                                        status = "failed"
-                                        message = "dovecot_login authenticator failed"
-        elif kind == "rejectlog":
-            m = LOG_PATTERNS["rejectlog"].match(line)
-            if m:
-                ts = datetime.strptime(m.group("ts"), "%Y-%m-%d %H:%M:%S")
-                sender = m.group("from")
-                recipient = m.group("recipient")
-                status = "rejected"
-                message = m.group("error")
-        elif kind == "paniclog":
-            m = LOG_PATTERNS["paniclog"].match(line)
-            if m:
-                ts = datetime.strptime(m.group("ts"), "%Y-%m-%d %H:%M:%S")
-                status = "panic"
-        # normalize addresses
-        sender = self._norm_addr(sender)
-        recipient = self._norm_addr(recipient)
-        ev = {
-            "server_name": self.cfg.get("server_name"),
-            "kind": kind,
-            "timestamp": ts.isoformat(),
-            "sender": sender,
-            "recipient": recipient,
-            "status": status,
-            "message": message,
-            "message_id": message_id,
-        }
-        if qid:
-            ev["qid"] = qid
-        if meta:
-            ev["meta"] = meta
-        return ev
+                                    sender = m.group("user")
+                                    status = "failed"
+                                    message = "dovecot_login authenticator failed"
+    elif kind == "rejectlog":
+        m = LOG_PATTERNS["rejectlog"].match(line)
+        if m:
+            ts = datetime.strptime(m.group("ts"), "%Y-%m-%d %H:%M:%S")
+            sender = m.group("from")
+            recipient = m.group("recipient")
+            status = "rejected"
+            message = m.group("error")
+    elif kind == "paniclog":
+        m = LOG_PATTERNS["paniclog"].match(line)
+        if m:
+            ts = datetime.strptime(m.group("ts"), "%Y-%m-%d %H:%M:%S")
+            status = "panic"
+    # normalize addresses
+    sender = norm_addr(sender)
+    recipient = norm_addr(recipient)
+    ev = {
+        "server_name": server_name,
+        "kind": kind,
+        "timestamp": ts.isoformat(),
+        "sender": sender,
+        "recipient": recipient,
+        "status": status,
+        "message": message,
+        "message_id": message_id,
+    }
+    if qid:
+        ev["qid"] = qid
+    if meta:
+        ev["meta"] = meta
+    return ev
+
+def parse_lines(kind: str, lines: List[str], server_name: Optional[str]) -> List[Dict]:
+    # Unit of work for the parser pool; module level so it can be pickled
+    return [parse_line(kind, line, server_name) for line in lines]
+
+class Sender:
+    """Posts batches to the backend over one shared keep-alive session.
 
-    def _update_qid_cache(self, ev: Dict):
+    Batch size and send rate adapt to 429/Retry-After per API key, since the
+    backend's ingest quotas are keyed by API key; sources sharing a key share
+    its backpressure state.
+    """
+
+    def __init__(self, cfg: Dict):
+        self.verbose = bool(cfg.get("verbose", False))
+        # batch_size is the ceiling; the effective size adapts to backpressure
+        self.max_batch_size = max(1, int(cfg.get("batch_size", 200)))
+        self.post_retries = int(cfg.get("post_retries", 3))
+        # Longest a post() waits out 429s before giving up on the cycle, so a
+        # throttled key cannot hold the polling loop (and other keys) forever
+        self.max_throttle_seconds = float(cfg.get("max_throttle_seconds", 60))
+        self.http = requests.Session()
+        # Enough pooled connections for every concurrent sender thread
+        pool_size = max(10, int(cfg.get("send_workers", 4)))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+        self._keys: Dict[str, Dict] = {}
+
+    def _key_state(self, api_key: str) -> Dict:
+        st = self._keys.get(api_key)
+        if st is None:
+            st = {
+                "max_batch_size": self.max_batch_size,
+                "batch_size": self.max_batch_size,
+                "send_interval": 0.0,
+                "next_send": 0.0,
+            }
+            self._keys[api_key] = st
+        return st
+
+    def _throttled(self, st: Dict, r) -> float:
+        """React to a 429: halve the batch size, slow the send rate, return the wait."""
+        try:
+            wait = float(r.headers.get("Retry-After", 1))
+        except ValueError:
+            wait = 1.0
+        st["batch_size"] = max(1, st["batch_size"] // 2)
+        st["send_interval"] = min(max(st["send_interval"] * 2, 0.05), 5.0)
+        limit = r.headers.get("X-Quota-Events-Limit")
+        if limit and limit.isdigit():
+            st["max_batch_size"] = max(1, min(st["max_batch_size"], int(limit)))
+        if self.verbose:
+            print(f"[agent] throttled: retry in {wait}s, batch_size={st['batch_size']} interval={st['send_interval']:.2f}s")
+        return min(wait, 60.0)
+
+    def _accepted(self, st: Dict):
+        # Additive increase back towards the configured batch size and full speed
+        st["batch_size"] = min(st["max_batch_size"], st["batch_size"] + max(1, st["max_batch_size"] // 10))
+        st["send_interval"] = st["send_interval"] / 2 if st["send_interval"] > 0.01 else 0.0
+
+    def post(self, url: str, api_key: str, batch: List[Dict]) -> bool:
+        st = self._key_state(api_key)
+        headers = {"X-API-Key": api_key}
+        pos = 0
+        attempt = 0
+        deadline = time.monotonic() + self.max_throttle_seconds
+        while pos < len(batch):
+            if st["next_send"] > deadline:
+                # Still throttled: the caller rolls the cycle back and the
+                # events go out again next cycle
+                if self.verbose:
+                    print(f"[agent] still throttled after {self.max_throttle_seconds}s, deferring {len(batch) - pos} events")
+                return False
+            delay = st["next_send"] - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            chunk = batch[pos:pos + st["batch_size"]]
+            try:
+                if self.verbose:
+                    print(f"[agent] posting batch size={len(chunk)} to {url}")
+                r = self.http.post(url, json=chunk, headers=headers, timeout=10)
+                if r.status_code == 429:
+                    # Backpressure is not a failure: wait as told and resend smaller
+                    st["next_send"] = time.monotonic() + self._throttled(st, r)
+                    continue
+                r.raise_for_status()
+                if self.verbose:
+                    body = r.json()
+                    print(f"[agent] ingested={body.get('ingested')} duplicates={body.get('duplicates')}")
+            except Exception as e:
+                if self.verbose:
+                    print(f"[agent] post error (attempt {attempt + 1}): {e}")
+                if attempt == self.post_retries:
+                    # Chunks already accepted are harmless: event ids make the
+                    # re-send after rollback idempotent
+                    return False
+                time.sleep(min(2 ** attempt, 30))
+                attempt += 1
+                continue
+            pos += len(chunk)
+            attempt = 0
+            self._accepted(st)
+            st["next_send"] = time.monotonic() + st["send_interval"]
+        return True
+
+class Agent:
+    def __init__(self, cfg: Dict, sender: Optional[Sender] = None):
+        self.cfg = cfg
+        self.state_path = cfg.get("state_file", "./state.json")
+        self.qid_flush_seconds = int(self.cfg.get("qid_flush_seconds", 600))
+        self.max_qid_cache = int(self.cfg.get("max_qid_cache", 10000))
+        self.verbose = bool(self.cfg.get("verbose", False))
+        # Shared with other sources when running under AgentHost
+        self.sender = sender or Sender(cfg)
+        # Checkpoints are written on their own schedule (0 = after every cycle)
+        self.checkpoint_interval = int(self.cfg.get("checkpoint_interval_seconds", 60))
+        # Lines read per log per cycle. A cycle is all-or-nothing, so it has to
+        # fit in what the ingest quota admits within max_throttle_seconds, or
+        # a large backlog (first start on an old mainlog) would never drain
+        self.max_lines_per_cycle = max(1, int(self.cfg.get("max_lines_per_cycle", 2000)))
+        # Effective limit: halved after a cycle is rolled back (e.g. still
+        # throttled at the deadline), doubled back after each commit
+        self.lines_per_cycle = self.max_lines_per_cycle
+        # Set when a read stopped at max_lines_per_cycle: run again without waiting
+        self.backlogged = False
+        self._last_checkpoint = time.monotonic()
+        # Correlation cache, checkpointed together with the offsets it matches
+        self.qid_cache: Dict[str, Dict] = {}
+        self._pending_sender = {"value": None, "ts": None}
+        self._cycle_backup = None
+        self.state = self._load_state()
+
+    def _load_state(self) -> Dict:
+        if not os.path.exists(self.state_path):
+            return {"offsets": {}}
+        with open(self.state_path, "r") as f:
+            state = json.load(f)
+        snapshot = state.pop("qid_snapshot", None)
+        if snapshot:
+            try:
+                self.qid_cache = marshal.loads(zlib.decompress(base64.b64decode(snapshot)))
+            except (ValueError, EOFError, TypeError, zlib.error) as e:
+                # Unreadable snapshot: keep the offsets, start correlation from scratch
+                print(f"[agent] discarding qid snapshot: {e}")
+                self.qid_cache = {}
+        pending = state.pop("pending_sender", None)
+        if pending:
+            self._pending_sender = pending
+        state.setdefault("offsets", {})
+        return state
+
+    def _snapshot_cache(self) -> str:
+        # marshal only handles builtin types, which is all the cache holds; it is
+        # much faster than JSON for large caches and zlib keeps the file small
+        raw = marshal.dumps(self.qid_cache, 4)
+        return base64.b64encode(zlib.compress(raw, 1)).decode("ascii")
+
+    def _save_state(self):
+        state_dir = os.path.dirname(self.state_path) or "."
+        os.makedirs(state_dir, exist_ok=True)
+        data = dict(self.state)
+        data["qid_snapshot"] = self._snapshot_cache()
+        data["pending_sender"] = self._pending_sender
+        # Write to a temp file in the same directory and rename over the old
+        # checkpoint, so a crash never leaves a truncated state file behind
+        fd, tmp_path = tempfile.mkstemp(prefix=".state-", dir=state_dir)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.state_path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        self._last_checkpoint = time.monotonic()
+
+    def _maybe_checkpoint(self):
+        if time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+            self._save_state()
+
+    def _begin_cycle(self):
+        # Cheap copy of the correlation state so a failed cycle can be undone;
+        # the cache must only ever reflect lines whose offsets were committed
+        self._cycle_backup = (
+            {qid: dict(c) for qid, c in self.qid_cache.items()},
+            dict(self._pending_sender),
+        )
+
+    def _rollback_cycle(self):
+        # A failed cycle waits for the normal interval before retrying
+        self.backlogged = False
+        if self._cycle_backup is not None:
+            self.lines_per_cycle = max(1, self.lines_per_cycle // 2)
+            self.qid_cache, self._pending_sender = self._cycle_backup
+            self._cycle_backup = None
+
+    def _event_id(self, origin: str, etype: str) -> str:
+        # Deterministic identity: the same log line always yields the same id,
+        # so retries and re-reads are deduplicated by the backend
+        key = f"{self.cfg.get('server_name')}:{origin}:{etype}"
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _update_qid_cache(self, ev: Dict, origin: str):
         qid = ev.get("qid")
         if not qid:
             return
         c = self.qid_cache.get(qid) or {
+            "origin": origin,
             "first_ts": ev["timestamp"],
             "last_ts": ev["timestamp"],
             "sender": None,
@@ -267,7 +459,10 @@ class Agent:
         if c.get("size"): parts.append(f"S={c['size']}")
         if c.get("reply"): parts.append(f"C=\"{c['reply']}\"")
         msg = "; ".join(parts) if parts else None
+        # Entries restored from older snapshots have no origin; fall back to the QID
+        origin = c.get("origin") or f"qid:{qid}:{c.get('first_ts')}"
         return {
+            "event_id": self._event_id(origin, "flush"),
             "server_name": self.cfg.get("server_name"),
             "kind": "mainlog",
             "timestamp": c.get("last_ts") or c.get("first_ts"),
@@ -296,134 +491,289 @@ class Agent:
                 out.append(item)
         return out
 
-    def _read_new_lines(self, path: str, offset: int) -> (List[str], int):
+    def _read_new_lines(self, path: str, offset: int) -> Tuple[List[Tuple[str, str]], int]:
+        """Return (origin, line) pairs for complete lines after offset, plus the new offset.
+
+        The origin ("<inode>:<byte offset>") identifies the line for event ids.
+        A trailing partial line is left for the next cycle so offsets stay on
+        line boundaries.
+        """
         lines = []
         new_offset = offset
         try:
-            with open(path, "r", errors="ignore") as f:
+            # Cheap check first: with many sources most files are idle each cycle
+            if os.stat(path).st_size == offset:
+                return [], offset
+            with open(path, "rb") as f:
+                inode = os.fstat(f.fileno()).st_ino
                 f.seek(offset)
-                for line in f:
-                    lines.append(line)
-                new_offset = f.tell()
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        break
+                    if len(lines) >= self.lines_per_cycle:
+                        self.backlogged = True
+                        break
+                    lines.append((f"{inode}:{new_offset}", raw.decode("utf-8", errors="ignore")))
+                    new_offset += len(raw)
         except FileNotFoundError:
             return [], offset
         return lines, new_offset
 
-    def run_once(self):
-        batch = []
+    def read_pending(self) -> List[Tuple[str, str, List[Tuple[str, str]], int]]:
+        """Read new lines of every log: [(kind, path, [(origin, line)], new_offset)]."""
         offsets = self.state.get("offsets", {})
-        for kind, path in self.cfg.get("logs", {}).items():
-            off = offsets.get(path, 0)
-            lines, new_off = self._read_new_lines(path, off)
-            for line in lines:
-                ev = self._parse_line(kind, line)
-                # Skip noise-only lines for mainlog unless correlated via QID
-                if kind == "mainlog":
-                    # If this is a sender-only line (no QID), keep pending sender for short window
-                    if not ev.get("qid") and ev.get("sender") and not (ev.get("recipient") or ev.get("status")):
-                        self._pending_sender = {"value": ev.get("sender"), "ts": ev.get("timestamp")}
-                        if self.verbose:
-                            print(f"[agent] pending sender set to {ev.get('sender')}")
-                        # do not emit this line as an event
-                        continue
-                    # If QID event lacks sender, try to attach the most recent pending sender if fresh
-                    if ev.get("qid"):
-                        if not ev.get("sender") and self._pending_sender.get("value"):
-                            try:
-                                pts = datetime.fromisoformat(self._pending_sender["ts"]) if isinstance(self._pending_sender.get("ts"), str) else self._pending_sender.get("ts")
-                            except Exception:
-                                pts = None
-                            if pts and (datetime.fromisoformat(ev["timestamp"]) - pts).total_seconds() <= 15:
-                                ev["sender"] = self._pending_sender["value"]
-                                if self.verbose:
-                                    print(f"[agent] attached pending sender {ev['sender']} to qid={ev['qid']}")
-                                # clear after use
-                                self._pending_sender = {"value": None, "ts": None}
-                        # update cache and check for completion
-                        if ev.get("completed"):
-                            flushed = self._flush_qid(ev["qid"])  # flush if exists
-                            if flushed:
-                                batch.append(flushed)
-                            continue
-                        # Update cache and emit immediate 'received' if not yet emitted
-                        self._update_qid_cache(ev)
-                        c = self.qid_cache.get(ev["qid"])
-                        if ev.get("status") == "received" and c and not c.get("emitted_received"):
-                            batch.append({
-                                "server_name": self.cfg.get("server_name"),
-                                "kind": "mainlog",
-                                "timestamp": ev.get("timestamp"),
-                                "sender": ev.get("sender"),
-                                "recipient": ev.get("recipient"),
-                                "status": "received",
-                                "message": None,
-                                "message_id": ev.get("message_id"),
-                            })
-                            if self.verbose:
-                                print(f"[agent] received qid={ev.get('qid')} sender={ev.get('sender')} recipient={ev.get('recipient')}")
-                            c["emitted_received"] = True
-                        elif ev.get("status") == "delivered" and c and not c.get("emitted_delivered"):
-                            batch.append({
-                                "server_name": self.cfg.get("server_name"),
-                                "kind": "mainlog",
-                                "timestamp": ev.get("timestamp"),
-                                "sender": ev.get("sender"),
-                                "recipient": ev.get("recipient"),
-                                "status": "delivered",
-                                "message": ev.get("meta", {}).get("reply"),
-                                "message_id": ev.get("message_id"),
-                            })
-                            if self.verbose:
-                                print(f"[agent] delivered qid={ev.get('qid')} recipient={ev.get('recipient')}")
-                            c["emitted_delivered"] = True
-                        elif ev.get("status") == "accepted" and c and not c.get("emitted_accepted"):
-                            batch.append({
-                                "server_name": self.cfg.get("server_name"),
-                                "kind": "mainlog",
-                                "timestamp": ev.get("timestamp"),
-                                "sender": ev.get("sender"),
-                                "recipient": ev.get("recipient"),
-                                "status": "accepted",
-                                "message": None,
-                                "message_id": ev.get("message_id"),
-                            })
-                            if self.verbose:
-                                print(f"[agent] accepted qid={ev.get('qid')} recipient={ev.get('recipient')}")
-                            c["emitted_accepted"] = True
-                        continue
-                    # No QID: keep only if has meaningful fields
-                    if not (ev.get("sender") or ev.get("recipient") or ev.get("message_id") or ev.get("status")):
-                        continue
-                    batch.append(ev)
-                else:
-                    # rejectlog/paniclog pass-through
-                    batch.append(ev)
+        self.backlogged = False
+        return [
+            (kind, path) + self._read_new_lines(path, offsets.get(path, 0))
+            for kind, path in self.cfg.get("logs", {}).items()
+        ]
+
+    def parse_pending(self, reads) -> List[List[Dict]]:
+        server_name = self.cfg.get("server_name")
+        return [parse_lines(kind, [line for _, line in lines], server_name) for kind, _, lines, _ in reads]
+
+    def build_batch(self, reads, parsed: List[List[Dict]]) -> Tuple[List[Dict], Dict[str, int]]:
+        """Correlate parsed events into the outgoing batch; return it with the offsets it covers."""
+        batch: List[Dict] = []
+        offsets = dict(self.state.get("offsets", {}))
+        for (kind, path, lines, new_off), events in zip(reads, parsed):
+            for (origin, _), ev in zip(lines, events):
+                self._correlate(kind, origin, ev, batch)
             offsets[path] = new_off
         # Flush timeouts for pending QIDs
         batch.extend(self._flush_timeouts())
-        if batch:
-            headers = {"X-API-Key": self.cfg.get("api_key")}
-            url = self.cfg.get("api_url")
-            try:
-                if self.verbose:
-                    print(f"[agent] posting batch size={len(batch)} to {url}")
-                r = requests.post(url, json=batch, headers=headers, timeout=10)
-                r.raise_for_status()
-            except Exception as e:
+        return batch, offsets
+
+    def _correlate(self, kind: str, origin: str, ev: Dict, batch: List[Dict]):
+        # Skip noise-only lines for mainlog unless correlated via QID
+        if kind == "mainlog":
+            # If this is a sender-only line (no QID), keep pending sender for short window
+            if not ev.get("qid") and ev.get("sender") and not (ev.get("recipient") or ev.get("status")):
+                self._pending_sender = {"value": ev.get("sender"), "ts": ev.get("timestamp")}
                 if self.verbose:
-                    print(f"[agent] post error: {e}")
+                    print(f"[agent] pending sender set to {ev.get('sender')}")
+                # do not emit this line as an event
+                return
+            # If QID event lacks sender, try to attach the most recent pending sender if fresh
+            if ev.get("qid"):
+                if not ev.get("sender") and self._pending_sender.get("value"):
+                    try:
+                        pts = datetime.fromisoformat(self._pending_sender["ts"]) if isinstance(self._pending_sender.get("ts"), str) else self._pending_sender.get("ts")
+                    except Exception:
+                        pts = None
+                    if pts and (datetime.fromisoformat(ev["timestamp"]) - pts).total_seconds() <= 15:
+                        ev["sender"] = self._pending_sender["value"]
+                        if self.verbose:
+                            print(f"[agent] attached pending sender {ev['sender']} to qid={ev['qid']}")
+                        # clear after use
+                        self._pending_sender = {"value": None, "ts": None}
+                # update cache and check for completion
+                if ev.get("completed"):
+                    flushed = self._flush_qid(ev["qid"])  # flush if exists
+                    if flushed:
+                        batch.append(flushed)
+                    return
+                # Update cache and emit immediate 'received' if not yet emitted
+                self._update_qid_cache(ev, origin)
+                c = self.qid_cache.get(ev["qid"])
+                if ev.get("status") == "received" and c and not c.get("emitted_received"):
+                    batch.append({
+                        "event_id": self._event_id(origin, "received"),
+                        "server_name": self.cfg.get("server_name"),
+                        "kind": "mainlog",
+                        "timestamp": ev.get("timestamp"),
+                        "sender": ev.get("sender"),
+                        "recipient": ev.get("recipient"),
+                        "status": "received",
+                        "message": None,
+                        "message_id": ev.get("message_id"),
+                    })
+                    if self.verbose:
+                        print(f"[agent] received qid={ev.get('qid')} sender={ev.get('sender')} recipient={ev.get('recipient')}")
+                    c["emitted_received"] = True
+                elif ev.get("status") == "delivered" and c and not c.get("emitted_delivered"):
+                    batch.append({
+                        "event_id": self._event_id(origin, "delivered"),
+                        "server_name": self.cfg.get("server_name"),
+                        "kind": "mainlog",
+                        "timestamp": ev.get("timestamp"),
+                        "sender": ev.get("sender"),
+                        "recipient": ev.get("recipient"),
+                        "status": "delivered",
+                        "message": ev.get("meta", {}).get("reply"),
+                        "message_id": ev.get("message_id"),
+                    })
+                    if self.verbose:
+                        print(f"[agent] delivered qid={ev.get('qid')} recipient={ev.get('recipient')}")
+                    c["emitted_delivered"] = True
+                elif ev.get("status") == "accepted" and c and not c.get("emitted_accepted"):
+                    batch.append({
+                        "event_id": self._event_id(origin, "accepted"),
+                        "server_name": self.cfg.get("server_name"),
+                        "kind": "mainlog",
+                        "timestamp": ev.get("timestamp"),
+                        "sender": ev.get("sender"),
+                        "recipient": ev.get("recipient"),
+                        "status": "accepted",
+                        "message": None,
+                        "message_id": ev.get("message_id"),
+                    })
+                    if self.verbose:
+                        print(f"[agent] accepted qid={ev.get('qid')} recipient={ev.get('recipient')}")
+                    c["emitted_accepted"] = True
                 return
+            # No QID: keep only if has meaningful fields
+            if not (ev.get("sender") or ev.get("recipient") or ev.get("message_id") or ev.get("status")):
+                return
+            ev["event_id"] = self._event_id(origin, kind)
+            batch.append(ev)
+        else:
+            # rejectlog/paniclog pass-through
+            ev["event_id"] = self._event_id(origin, kind)
+            batch.append(ev)
+
+    def commit(self, offsets: Dict[str, int]):
         self.state["offsets"] = offsets
-        self._save_state()
+        self.lines_per_cycle = min(self.max_lines_per_cycle, self.lines_per_cycle * 2)
+        self._cycle_backup = None
+
+    def run_once(self):
+        self._begin_cycle()
+        try:
+            reads = self.read_pending()
+            batch, offsets = self.build_batch(reads, self.parse_pending(reads))
+            if batch and not self.sender.post(self.cfg.get("api_url"), self.cfg.get("api_key"), batch):
+                self._rollback_cycle()
+                return
+            self.commit(offsets)
+        except BaseException:
+            self._rollback_cycle()
+            raise
+
+    def run(self):
+        interval = int(self.cfg.get("interval_seconds", 10))
+        try:
+            while True:
+                self.run_once()
+                self._maybe_checkpoint()
+                if not self.backlogged:
+                    time.sleep(interval)
+        finally:
+            # Final checkpoint on shutdown; a cycle interrupted mid-way has
+            # already been rolled back, so this is consistent with the offsets
+            self._save_state()
+
+class AgentHost:
+    """Runs many sources (Exim instances, containers) in one agent process.
+
+    Each source is an Agent with its own server identity, QID cache, offsets
+    and state file. They share one polling loop, an optional process pool for
+    parsing large reads, and one Sender whose batches are grouped per API key
+    and posted concurrently.
+    """
+
+    def __init__(self, cfg: Dict):
+        self.cfg = cfg
+        self.verbose = bool(cfg.get("verbose", False))
+        self.sender = Sender(cfg)
+        # Top-level keys are defaults for every source; without "sources" the
+        # config itself is the single source (the original config.json layout)
+        defaults = {k: v for k, v in cfg.items() if k != "sources"}
+        sources = cfg.get("sources") or [{}]
+        self.agents = [Agent({**defaults, **src}, sender=self.sender) for src in sources]
+        state_files = [a.state_path for a in self.agents]
+        if len(set(state_files)) != len(state_files):
+            raise ValueError("each source needs its own state_file")
+        # Parsing is CPU bound, so it goes to processes; 0 parses inline
+        self.parse_workers = int(cfg.get("parse_workers", 0))
+        # Reads smaller than this are parsed inline, IPC would cost more than it saves
+        self.parse_chunk_lines = max(1, int(cfg.get("parse_chunk_lines", 2000)))
+        self._parse_pool = ProcessPoolExecutor(self.parse_workers) if self.parse_workers > 0 else None
+        self._send_pool = ThreadPoolExecutor(max(1, int(cfg.get("send_workers", 4))))
+
+    def _parse_all(self, reads_by_agent) -> List[List[List[Dict]]]:
+        if not self._parse_pool:
+            return [a.parse_pending(reads) for a, reads in zip(self.agents, reads_by_agent)]
+        # Submit every chunk first so the pool works on all sources at once
+        pending = []
+        for a, reads in zip(self.agents, reads_by_agent):
+            server_name = a.cfg.get("server_name")
+            per_log = []
+            for kind, _, lines, _ in reads:
+                texts = [line for _, line in lines]
+                if len(texts) < self.parse_chunk_lines:
+                    per_log.append([parse_lines(kind, texts, server_name)])
+                    continue
+                per_log.append([
+                    self._parse_pool.submit(parse_lines, kind, texts[i:i + self.parse_chunk_lines], server_name)
+                    for i in range(0, len(texts), self.parse_chunk_lines)
+                ])
+            pending.append(per_log)
+        parsed = []
+        for per_log in pending:
+            parsed.append([
+                [ev for chunk in chunks for ev in (chunk.result() if isinstance(chunk, Future) else chunk)]
+                for chunks in per_log
+            ])
+        return parsed
+
+    def run_once(self):
+        for a in self.agents:
+            a._begin_cycle()
+        try:
+            reads_by_agent = [a.read_pending() for a in self.agents]
+            parsed_by_agent = self._parse_all(reads_by_agent)
+            # One outgoing batch per (url, API key), shared by the sources using it
+            groups: Dict[Tuple[str, str], Tuple[List[Dict], List[Tuple[Agent, Dict[str, int]]]]] = {}
+            for a, reads, parsed in zip(self.agents, reads_by_agent, parsed_by_agent):
+                batch, offsets = a.build_batch(reads, parsed)
+                key = (a.cfg.get("api_url"), a.cfg.get("api_key"))
+                group = groups.setdefault(key, ([], []))
+                group[0].extend(batch)
+                group[1].append((a, offsets))
+            # Each group commits or rolls back as soon as its post finishes, so a
+            # throttled or failing key only holds back the sources using it
+            futures = {
+                self._send_pool.submit(self.sender.post, url, api_key, batch): members
+                for (url, api_key), (batch, members) in groups.items() if batch
+            }
+            for batch, members in groups.values():
+                if not batch:
+                    for a, offsets in members:
+                        a.commit(offsets)
+            for future in as_completed(futures):
+                ok = future.result()
+                for a, offsets in futures[future]:
+                    if ok:
+                        a.commit(offsets)
+                    else:
+                        a._rollback_cycle()
+        except BaseException:
+            # Sources already committed are left alone (their backup is cleared)
+            for a in self.agents:
+                a._rollback_cycle()
+            raise
 
     def run(self):
         interval = int(self.cfg.get("interval_seconds", 10))
-        while True:
-            self.run_once()
-            time.sleep(interval)
+        try:
+            while True:
+                self.run_once()
+                for a in self.agents:
+                    a._maybe_checkpoint()
+                if not any(a.backlogged for a in self.agents):
+                    time.sleep(interval)
+        finally:
+            for a in self.agents:
+                a._save_state()
+            self._send_pool.shutdown(wait=False)
+            if self._parse_pool:
+                self._parse_pool.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
     cfg_path = os.getenv("AGENT_CONFIG", "config.json")
     with open(cfg_path, "r") as f:
         cfg = json.load(f)
-    Agent(cfg).run()
+    # Turn SIGTERM (docker stop, systemd) into a clean exit so the final checkpoint runs
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    AgentHost(cfg).run()
@@ -1,5 +1,7 @@
 import os
 from sqlalchemy import create_engine
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./mailmon.db")
@@ -14,3 +16,9 @@ def get_db():
         yield db
     finally:
         db.close()
+
+def dialect_insert(db):
+    """insert() of the bound dialect, for ON CONFLICT support (Postgres or SQLite)."""
+    if db.get_bind().dialect.name == "postgresql":
+        return pg_insert
+    return sqlite_insert
@@ -1,12 +1,120 @@
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Optional, Tuple
 from fastapi import Header, HTTPException, Depends
 from sqlalchemy.orm import Session
 from .db import get_db
+from .localstore import LocalStore
 from .models import Server
 
+# Deletions reach every worker through the generation counter; the TTL only
+# bounds staleness after changes made outside the API
+SERVER_CACHE_TTL = float(os.getenv("SERVER_CACHE_TTL", "600"))
+SERVER_CACHE_STATE_PATH = os.getenv("SERVER_CACHE_STATE_PATH", os.path.join(tempfile.gettempdir(), "mailmon-servers.db"))
+
+class ServerCache:
+    """Per-process API key / server name -> Server lookups with a TTL.
+
+    Cached rows are detached copies holding only column values. Misses always
+    go to the database, so new servers work at once. invalidate() bumps a
+    generation counter in a LocalStore file; every lookup compares it with the
+    generation its entries were loaded under, so a deleted server stops being
+    accepted by all workers on the host at once.
+    """
+
+    def __init__(self, ttl: float, store: LocalStore):
+        self.ttl = ttl
+        self.store = store
+        self._generation: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self.warmed = False
+        self._by_key: Dict[str, Tuple[Server, float]] = {}
+        self._by_name: Dict[str, Tuple[Server, float]] = {}
+        self._lock = threading.Lock()
+
+    def _put(self, db: Session, server: Server):
+        db.expunge(server)
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._by_key[server.api_key] = (server, expires)
+            self._by_name[server.name] = (server, expires)
+
+    def _get(self, index: Dict[str, Tuple[Server, float]], value: str) -> Optional[Server]:
+        with self._lock:
+            entry = index.get(value)
+            if entry and entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def _current_generation(self) -> int:
+        row = self.store.read("SELECT value FROM generation WHERE id = 1")
+        return row[0] if row else 0
+
+    def _check_generation(self):
+        generation = self._current_generation()
+        if generation != self._generation:
+            # Recorded before any reload, so rows read before a concurrent
+            # deletion are dropped again on the next lookup
+            with self._lock:
+                self._by_key.clear()
+                self._by_name.clear()
+                self._generation = generation
+
+    def warm(self, db: Session):
+        self._generation = self._current_generation()
+        for server in db.query(Server).all():
+            self._put(db, server)
+        self.warmed = True
+
+    def by_api_key(self, db: Session, api_key: str) -> Optional[Server]:
+        self._check_generation()
+        server = self._get(self._by_key, api_key)
+        if server is None:
+            server = db.query(Server).filter(Server.api_key == api_key).first()
+            if server:
+                self._put(db, server)
+        return server
+
+    def by_name(self, db: Session, name: str) -> Optional[Server]:
+        self._check_generation()
+        server = self._get(self._by_name, name)
+        if server is None:
+            server = db.query(Server).filter(Server.name == name).first()
+            if server:
+                self._put(db, server)
+        return server
+
+    def invalidate(self):
+        """Drop cached servers in every worker; call after the change is committed."""
+        with self.store.transaction() as conn:
+            conn.execute(
+                "INSERT INTO generation (id, value) VALUES (1, 1) "
+                "ON CONFLICT (id) DO UPDATE SET value = value + 1"
+            )
+        with self._lock:
+            self._by_key.clear()
+            self._by_name.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._by_key), "hits": self.hits, "misses": self.misses}
+
+server_cache = ServerCache(
+    SERVER_CACHE_TTL,
+    LocalStore(
+        SERVER_CACHE_STATE_PATH,
+        "CREATE TABLE IF NOT EXISTS generation (id INTEGER PRIMARY KEY, value INTEGER NOT NULL)",
+    ),
+)
+
 async def api_key_checker(x_api_key: str = Header(None), db: Session = Depends(get_db)) -> Server:
     if not x_api_key:
         raise HTTPException(status_code=401, detail="Missing API key")
-    server = db.query(Server).filter(Server.api_key == x_api_key).first()
+    server = server_cache.by_api_key(db, x_api_key)
     if not server:
         raise HTTPException(status_code=403, detail="Invalid API key")
     return server
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from .db import dialect_insert
+from .models import MailAddress, MailStatus, MailTemplate
+
+DICTIONARY_CACHE_SIZE = int(os.getenv("DICTIONARY_CACHE_SIZE", "50000"))
+# Values per INSERT/IN statement
+CHUNK = 1000
+
+def value_hash(value: str) -> str:
+    # Same digest as Postgres md5(text), which the migration relies on
+    return hashlib.md5(value.encode("utf-8")).hexdigest()
+
+class Interner:
+    """Resolves values of one dictionary table to ids, with an in-process LRU in front.
+
+    Ids never change once assigned, so cached entries never go stale; only
+    committed ids are cached.
+    """
+
+    def __init__(self, model, maxsize: int = DICTIONARY_CACHE_SIZE):
+        self.model = model
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, value: str) -> Optional[int]:
+        with self._lock:
+            id_ = self._cache.get(value)
+            if id_ is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._cache.move_to_end(value)
+            return id_
+
+    def _remember(self, value: str, id_: int):
+        with self._lock:
+            self._cache[value] = id_
+            self._cache.move_to_end(value)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def _fetch(self, db: Session, by_hash: Dict[str, str]) -> Dict[str, int]:
+        rows = db.execute(select(self.model.id, self.model.hash).where(self.model.hash.in_(list(by_hash)))).all()
+        out = {}
+        for id_, h in rows:
+            out[by_hash[h]] = id_
+            self._remember(by_hash[h], id_)
+        return out
+
+    def lookup(self, db: Session, value: str) -> Optional[int]:
+        """Id of an existing value, or None; never inserts."""
+        id_ = self._cached(value)
+        if id_ is not None:
+            return id_
+        return self._fetch(db, {value_hash(value): value}).get(value)
+
+    def resolve(self, db: Session, values: Iterable[Optional[str]]) -> Dict[str, int]:
+        """Map every non-null value to its id, inserting the missing ones.
+
+        New values are committed before their ids are cached, so a later
+        rollback of the caller's rows cannot leave dangling ids in the cache.
+        """
+        out: Dict[str, int] = {}
+        missing: Dict[str, str] = {}
+        for v in set(values):
+            if v is None:
+                continue
+            id_ = self._cached(v)
+            if id_ is None:
+                missing[value_hash(v)] = v
+            else:
+                out[v] = id_
+        if missing:
+            insert = dialect_insert(db)
+            items = list(missing.items())
+            for i in range(0, len(items), CHUNK):
+                db.execute(
+                    insert(self.model)
+                    .values([{"hash": h, "value": v} for h, v in items[i:i + CHUNK]])
+                    .on_conflict_do_nothing(index_elements=["hash"])
+                )
+            db.commit()
+            for i in range(0, len(items), CHUNK):
+                out.update(self._fetch(db, dict(items[i:i + CHUNK])))
+        return out
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._cache), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+statuses = Interner(MailStatus)
+addresses = Interner(MailAddress)
+templates = Interner(MailTemplate)
@@ -1,12 +1,71 @@
 import os
+import sqlite3
+import time
+from limits.storage import Storage
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from fastapi.responses import JSONResponse
+from .localstore import LocalStore
 
 rate_per_minute = os.getenv("RATE_LIMIT_PER_MINUTE", "120")
+# memory:// counts per process; the production launcher (app.serve) switches
+# to sqlite:///<file> so all workers share the counters. redis:// etc. also work.
+storage_uri = os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
 
-limiter = Limiter(key_func=get_remote_address, default_limits=[f"{rate_per_minute}/minute"]) 
+class SQLiteStorage(Storage):
+    """Fixed-window counters for `limits` kept in a LocalStore file (sqlite:///path)."""
+
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri: str, wrap_exceptions: bool = False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.store = LocalStore(
+            uri[len("sqlite:///"):],
+            "CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires REAL NOT NULL)",
+        )
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1) -> int:
+        now = time.time()
+        with self.store.transaction() as conn:
+            row = conn.execute("SELECT value, expires FROM counters WHERE key = ?", (key,)).fetchone()
+            if row and row[1] > now:
+                value, expires = row[0] + amount, row[1]
+            else:
+                value, expires = amount, now + expiry
+            if elastic_expiry:
+                expires = now + expiry
+            conn.execute("INSERT OR REPLACE INTO counters (key, value, expires) VALUES (?, ?, ?)", (key, value, expires))
+        return value
+
+    def get(self, key: str) -> int:
+        with self.store.transaction() as conn:
+            row = conn.execute("SELECT value, expires FROM counters WHERE key = ?", (key,)).fetchone()
+        return row[0] if row and row[1] > time.time() else 0
+
+    def get_expiry(self, key: str) -> float:
+        with self.store.transaction() as conn:
+            row = conn.execute("SELECT expires FROM counters WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else time.time()
+
+    def check(self) -> bool:
+        with self.store.transaction() as conn:
+            conn.execute("SELECT 1")
+        return True
+
+    def reset(self) -> int:
+        with self.store.transaction() as conn:
+            return conn.execute("DELETE FROM counters").rowcount
+
+    def clear(self, key: str) -> None:
+        with self.store.transaction() as conn:
+            conn.execute("DELETE FROM counters WHERE key = ?", (key,))
+
+limiter = Limiter(key_func=get_remote_address, default_limits=[f"{rate_per_minute}/minute"], storage_uri=storage_uri)
 
 async def rate_limit_handler(request, exc: RateLimitExceeded):
     return JSONResponse(status_code=429, content={"detail": "Rate limit exceeded"})
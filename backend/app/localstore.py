@@ -0,0 +1,48 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+class LocalStore:
+    """A SQLite file shared by every worker process on this host.
+
+    Used for state that must be coordinated across uvicorn/gunicorn workers
+    without an external service. transaction() takes the file's write lock
+    (BEGIN IMMEDIATE), so read-modify-write sequences are atomic across
+    processes.
+    """
+
+    def __init__(self, path: str, schema: str):
+        self.path = path
+        self.schema = schema
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not cross fork(); reopen in each worker
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(self.schema)
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def read(self, sql: str, params=()):
+        """First row of a read-only query; takes no write lock."""
+        with self._lock:
+            return self._connection().execute(sql, params).fetchone()
@@ -3,8 +3,12 @@ import os
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import text
-from .db import Base, engine
+from .db import SessionLocal, engine
+from .deps import server_cache
+from .migrations import prepare_database
 from .routers import auth, maillog, servers
+from . import dictionary
+from .metrics import instrument
 from .limits import limiter, rate_limit_handler
 from slowapi.errors import RateLimitExceeded
 from slowapi.middleware import SlowAPIMiddleware
@@ -34,11 +38,25 @@ app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, rate_limit_handler)
 app.add_middleware(SlowAPIMiddleware)
 
+# Timing/SQL instrumentation and /metrics; added last so it wraps everything
+instrument(app, engine, caches={
+    "dictionary_statuses": dictionary.statuses.stats,
+    "dictionary_addresses": dictionary.addresses.stats,
+    "dictionary_message_templates": dictionary.templates.stats,
+    "servers": server_cache.stats,
+})
+
 @app.on_event("startup")
 def on_startup():
-    Base.metadata.create_all(bind=engine)
-    with engine.connect() as conn:
-        conn.execute(text("SELECT 1"))
+    # The production launcher (app.serve) prepares the schema and warms the
+    # caches once in the master before forking; workers skip both
+    if os.getenv("MAILMON_SCHEMA_READY") != "1":
+        prepare_database(engine)
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    if not server_cache.warmed:
+        with SessionLocal() as db:
+            server_cache.warm(db)
 
 app.include_router(auth.router, prefix="/api")
 app.include_router(servers.router, prefix="/api")
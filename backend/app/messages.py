@@ -0,0 +1,38 @@
+import re
+from typing import Optional, Tuple
+
+# Exim messages repeat the same wording with different addresses, IPs, sizes,
+# ids and times. The wording (template) is interned once in mail_messages; the
+# variable parts stay on the log row, joined by PLACEHOLDER, which also marks
+# where each part was cut out of the template.
+PLACEHOLDER = "\x1f"
+
+_VARIABLE = re.compile(
+    r"[\w.+-]+@[\w.-]+"  # addresses
+    r"|\b[0-9A-Za-z]{6}-[0-9A-Za-z]{6,11}-[0-9A-Za-z]{2,4}\b"  # Exim message ids
+    r"|\d+(?:[.:-]\d+)*"  # numbers, IPv4 addresses, dates and times
+)
+
+def split_message(message: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """(template, params) for a message; join_message() gives the original back."""
+    if message is None:
+        return None, None
+    if PLACEHOLDER in message:
+        # Cannot be split unambiguously; the whole text stays inline
+        return None, message
+    params = _VARIABLE.findall(message)
+    if not params:
+        return message, None
+    return _VARIABLE.sub(PLACEHOLDER, message), PLACEHOLDER.join(params)
+
+def join_message(template: Optional[str], params: Optional[str]) -> Optional[str]:
+    if template is None:
+        return params
+    if params is None:
+        return template
+    pieces = template.split(PLACEHOLDER)
+    out = [pieces[0]]
+    for value, piece in zip(params.split(PLACEHOLDER), pieces[1:]):
+        out.append(value)
+        out.append(piece)
+    return "".join(out)
@@ -0,0 +1,256 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional, Set
+import fastapi.concurrency
+import fastapi.dependencies.utils
+import fastapi.routing
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import PlainTextResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from starlette.routing import Match
+
+logger = logging.getLogger("app.sql")
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+# Sampled per-request profiler (?profile=1); off by default
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "0") == "1"
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "1"))
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests", ["method", "route", "status"])
+HTTP_DURATION = Histogram("http_request_duration_seconds", "HTTP request latency", ["method", "route"])
+REQUEST_QUERIES = Histogram(
+    "http_request_db_queries", "SQL statements per request", ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+DB_QUERY_DURATION = Histogram("db_query_duration_seconds", "SQL statement latency", ["route"])
+DB_SLOW_QUERIES = Counter("db_slow_queries_total", "SQL statements slower than SLOW_QUERY_MS", ["route"])
+POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds", "Time to get a connection from the pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30),
+)
+INGEST_ROWS = Counter("ingest_rows_total", "Ingested events by outcome", ["result"])
+
+# Per-request accumulator, shared with the threadpool running sync routes
+_request_stats: ContextVar[Optional[Dict]] = ContextVar("request_stats", default=None)
+# Set when a session begins a transaction and consumed by the pool checkout
+# that follows in the same thread; the gap is the wait for a connection
+_checkout = threading.local()
+
+def _route_of(app: FastAPI, request: Request) -> str:
+    # Route template, not the raw path, to keep label cardinality bounded
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return getattr(route, "path", "unmatched")
+    return "unmatched"
+
+def _param_shape(params) -> str:
+    """Parameter types only, never values (they may carry addresses or keys)."""
+    if isinstance(params, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in params.items()) + "}"
+    if isinstance(params, (list, tuple)):
+        if params and isinstance(params[0], (dict, list, tuple)):
+            return f"{len(params)} x {_param_shape(params[0])}"
+        return "(" + ", ".join(type(v).__name__ for v in params) + ")"
+    return type(params).__name__
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = _request_stats.get()
+    route = stats["route"] if stats else "background"
+    if stats:
+        stats["queries"] += 1
+        stats["db_seconds"] += elapsed
+    DB_QUERY_DURATION.labels(route).observe(elapsed)
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        DB_SLOW_QUERIES.labels(route).inc()
+        logger.warning(
+            "slow query %.1f ms route=%s params=%s sql=%s",
+            elapsed * 1000, route, _param_shape(parameters), " ".join(statement.split()),
+        )
+
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute; drop its start
+    # so it does not pile up on the pooled connection
+    conn = context.connection
+    if conn is not None and conn.info.get("query_start"):
+        conn.info["query_start"].pop()
+
+def _transaction_started(session, transaction):
+    if transaction.parent is None:
+        _checkout.start = time.perf_counter()
+
+def _transaction_ended(session, transaction):
+    # A transaction that never touched the database must not leave a start
+    # behind for an unrelated checkout later in this thread
+    if transaction.parent is None:
+        _checkout.start = None
+
+def _pool_checkout(dbapi_connection, connection_record, connection_proxy):
+    start = getattr(_checkout, "start", None)
+    if start is not None:
+        _checkout.start = None
+        POOL_CHECKOUT_WAIT.observe(time.perf_counter() - start)
+
+class StackSampler:
+    """Samples the stacks of the threads serving one request, pyinstrument style.
+
+    sys._current_frames() sees the threadpool running sync routes, which a
+    profiler hooked into the calling thread would miss. Only threads in
+    `threads` are sampled: the event loop plus the pool threads the request
+    is using at that moment (see _track_threadpool), so concurrent requests
+    stay out of the profile, except for async code they run on the event
+    loop. Output is folded stacks (one "frame;frame;... count" per line) for
+    flamegraph tools.
+    """
+
+    def __init__(self, interval: float, threads: Set[int]):
+        self.interval = interval
+        self.threads = threads
+        self.samples = 0
+        self.counts: StackCounter = StackCounter()
+        self._app_dir = os.path.dirname(os.path.abspath(__file__))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.samples += 1
+            for tid, frame in sys._current_frames().items():
+                if tid not in self.threads:
+                    continue
+                stack = []
+                in_app = False
+                while frame is not None:
+                    code = frame.f_code
+                    in_app = in_app or (code.co_filename.startswith(self._app_dir) and code.co_filename != __file__)
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if in_app:
+                    self.counts[";".join(reversed(stack))] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self) -> str:
+        return "\n".join(f"{stack} {n}" for stack, n in self.counts.most_common())
+
+def _track_threadpool(run_in_threadpool):
+    """Wrap run_in_threadpool so a profiled request lists the pool thread running its code."""
+    async def run(func, *args, **kwargs):
+        def tracked(*a, **kw):
+            # The request's context is copied into the pool thread
+            stats = _request_stats.get()
+            threads = stats.get("threads") if stats else None
+            if threads is None:
+                return func(*a, **kw)
+            tid = threading.get_ident()
+            threads.add(tid)
+            try:
+                return func(*a, **kw)
+            finally:
+                threads.discard(tid)
+        return await run_in_threadpool(tracked, *args, **kwargs)
+    return run
+
+class _RuntimeCollector:
+    """Gauges read at scrape time: pool occupancy and in-process cache stats."""
+
+    def __init__(self, engine: Engine, caches: Dict[str, Callable[[], Dict[str, int]]]):
+        self.engine = engine
+        self.caches = caches
+
+    def collect(self):
+        pool = self.engine.pool
+        for name in ("size", "checkedout", "overflow", "checkedin"):
+            fn = getattr(pool, name, None)
+            # Only QueuePool has all of them; SingletonThreadPool.size is an int
+            if callable(fn):
+                g = GaugeMetricFamily(f"db_pool_{name}", f"SQLAlchemy pool {name}()")
+                g.add_metric([], fn())
+                yield g
+        families = {
+            "size": GaugeMetricFamily("app_cache_size", "In-process cache entries", labels=["cache"]),
+            "maxsize": GaugeMetricFamily("app_cache_maxsize", "In-process cache capacity", labels=["cache"]),
+            "hits": CounterMetricFamily("app_cache_hits", "In-process cache hits", labels=["cache"]),
+            "misses": CounterMetricFamily("app_cache_misses", "In-process cache misses", labels=["cache"]),
+        }
+        for cache, stats in self.caches.items():
+            values = stats()
+            for key, g in families.items():
+                if key in values:
+                    g.add_metric([cache], values[key])
+        yield from families.values()
+
+def instrument(app: FastAPI, engine: Engine, caches: Dict[str, Callable[[], Dict[str, int]]]):
+    """Attach timing middleware, SQL hooks and the /metrics endpoint to the app."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+    event.listen(engine, "checkout", _pool_checkout)
+    event.listen(Session, "after_transaction_create", _transaction_started)
+    event.listen(Session, "after_transaction_end", _transaction_ended)
+    if PROFILING_ENABLED:
+        # Sync routes and dependencies reach the threadpool through these
+        # module-level names
+        for module in (fastapi.routing, fastapi.dependencies.utils, fastapi.concurrency):
+            module.run_in_threadpool = _track_threadpool(module.run_in_threadpool)
+    runtime = _RuntimeCollector(engine, caches)
+    REGISTRY.register(runtime)
+
+    @app.middleware("http")
+    async def timing_middleware(request: Request, call_next):
+        route = _route_of(app, request)
+        stats = {"route": route, "queries": 0, "db_seconds": 0.0}
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        # An exception out of call_next is an unhandled error, served as a 500
+        status = "500"
+        try:
+            if PROFILING_ENABLED and request.query_params.get("profile") == "1":
+                stats["threads"] = {threading.get_ident()}
+                with StackSampler(PROFILE_INTERVAL_MS / 1000, stats["threads"]) as sampler:
+                    await call_next(request)
+                header = f"# route={route} samples={sampler.samples} queries={stats['queries']}\n"
+                response = PlainTextResponse(header + sampler.folded())
+            else:
+                response = await call_next(request)
+            status = str(response.status_code)
+        finally:
+            _request_stats.reset(token)
+            # Recorded for failed requests too, before the exception propagates
+            elapsed = time.perf_counter() - start
+            HTTP_REQUESTS.labels(request.method, route, status).inc()
+            HTTP_DURATION.labels(request.method, route).observe(elapsed)
+            REQUEST_QUERIES.labels(route).observe(stats["queries"])
+        response.headers["Server-Timing"] = f"db;dur={stats['db_seconds'] * 1000:.1f}, total;dur={elapsed * 1000:.1f}"
+        response.headers["X-DB-Queries"] = str(stats["queries"])
+        return response
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics():
+        registry = REGISTRY
+        if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+            # Multi-worker mode: counters/histograms are aggregated from every
+            # worker's files; pool and cache gauges are those of this worker
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            registry.register(runtime)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,199 @@
+import hashlib
+import logging
+from sqlalchemy import bindparam, inspect, text
+from sqlalchemy.engine import Engine
+from .db import Base
+from .messages import split_message
+from .models import MAIL_KIND_OTHER, MAIL_KINDS
+from .storage import format_report, table_sizes
+
+logger = logging.getLogger(__name__)
+
+def _columns(engine: Engine, table: str) -> set:
+    insp = inspect(engine)
+    if table not in insp.get_table_names():
+        return set()
+    return {c["name"] for c in insp.get_columns(table)}
+
+def add_maillog_event_id(engine: Engine):
+    cols = _columns(engine, "maillogs")
+    if not cols or "event_id" in cols:
+        return
+    logger.info("migration: adding maillogs.event_id")
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE maillogs ADD COLUMN event_id VARCHAR(64)"))
+
+def scope_event_id_per_server(engine: Engine):
+    """Replace the global unique index on event_id with (server_id, event_id)."""
+    if not _columns(engine, "maillogs"):
+        return
+    indexes = {i["name"] for i in inspect(engine).get_indexes("maillogs")}
+    if "ux_maillogs_server_event" in indexes and "ix_maillogs_event_id" not in indexes:
+        return
+    logger.info("migration: scoping maillogs.event_id uniqueness to the server")
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX IF EXISTS ix_maillogs_event_id"))
+        conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_maillogs_server_event ON maillogs (server_id, event_id)"
+        ))
+
+def _md5(value):
+    return hashlib.md5(value.encode("utf-8")).hexdigest() if value is not None else None
+
+# Rows per batch when messages are split in Python
+MESSAGE_BATCH = 5000
+
+def _template_messages(conn, source_sql: str):
+    """Fill message_template_id/message_params from (id, message) rows of source_sql.
+
+    Splitting needs the regexes in messages.py, so it runs here in batches
+    rather than in SQL; source_sql takes :after and :n for keyset paging.
+    """
+    after = 0
+    while True:
+        rows = conn.execute(text(source_sql), {"after": after, "n": MESSAGE_BATCH}).all()
+        if not rows:
+            return
+        after = rows[-1][0]
+        split = [(id_, *split_message(message)) for id_, message in rows]
+        by_hash = {_md5(t): t for _, t, _ in split if t is not None}
+        ids = {}
+        if by_hash:
+            conn.execute(
+                text("INSERT INTO mail_messages (hash, value) VALUES (:hash, :value) ON CONFLICT (hash) DO NOTHING"),
+                [{"hash": h, "value": t} for h, t in by_hash.items()],
+            )
+            ids = dict(conn.execute(
+                text("SELECT hash, id FROM mail_messages WHERE hash IN :hashes").bindparams(bindparam("hashes", expanding=True)),
+                {"hashes": list(by_hash)},
+            ).all())
+        conn.execute(
+            text("UPDATE maillogs SET message_template_id = :template_id, message_params = :params WHERE id = :id"),
+            [{"id": id_, "template_id": ids.get(_md5(t)), "params": p} for id_, t, p in split],
+        )
+
+def _vacuum(engine: Engine, *tables: str):
+    # Dropped columns and deleted rows only give space back after a rewrite;
+    # VACUUM cannot run inside a transaction
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if engine.dialect.name == "postgresql":
+            conn.execute(text(f"VACUUM FULL ANALYZE {', '.join(tables)}"))
+        elif engine.dialect.name == "sqlite":
+            conn.execute(text("VACUUM"))
+
+def encode_maillog_columns(engine: Engine):
+    """Move kind/status/sender/recipient into codes and dictionary tables, and
+    split message into an interned template plus inline parameters.
+
+    The dictionary tables already exist (create_all); values are interned by
+    md5, matching dictionary.value_hash, so ingest keeps using the same rows.
+    """
+    cols = _columns(engine, "maillogs")
+    if not cols or "sender" not in cols:
+        return
+    logger.info("migration: dictionary-encoding maillogs columns")
+    before = table_sizes(engine)
+    kind_case = (
+        "CASE kind "
+        + " ".join(f"WHEN '{name}' THEN {code}" for name, code in MAIL_KINDS.items())
+        + f" ELSE {MAIL_KIND_OTHER} END"
+    )
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            # Postgres has md5() built in; give SQLite the same function
+            conn.connection.dbapi_connection.create_function("md5", 1, _md5, deterministic=True)
+        for name, ddl in (
+            # NOT NULL needs a default to be added to a populated table; it is
+            # overwritten by the UPDATE below
+            ("kind_code", f"SMALLINT NOT NULL DEFAULT {MAIL_KIND_OTHER}"),
+            ("status_id", "INTEGER REFERENCES mail_statuses (id)"),
+            ("sender_id", "INTEGER REFERENCES mail_addresses (id)"),
+            ("recipient_id", "INTEGER REFERENCES mail_addresses (id)"),
+            ("message_template_id", "INTEGER REFERENCES mail_messages (id)"),
+            ("message_params", "TEXT"),
+        ):
+            if name not in cols:
+                conn.execute(text(f"ALTER TABLE maillogs ADD COLUMN {name} {ddl}"))
+        for table, source in (
+            ("mail_statuses", "SELECT status AS v FROM maillogs"),
+            ("mail_addresses", "SELECT sender AS v FROM maillogs UNION SELECT recipient AS v FROM maillogs"),
+        ):
+            conn.execute(text(
+                f"INSERT INTO {table} (hash, value) "
+                f"SELECT DISTINCT md5(v), v FROM ({source}) src WHERE v IS NOT NULL "
+                "ON CONFLICT (hash) DO NOTHING"
+            ))
+        conn.execute(text(
+            f"UPDATE maillogs SET kind_code = {kind_case}, "
+            "status_id = (SELECT id FROM mail_statuses d WHERE d.hash = md5(maillogs.status)), "
+            "sender_id = (SELECT id FROM mail_addresses d WHERE d.hash = md5(maillogs.sender)), "
+            "recipient_id = (SELECT id FROM mail_addresses d WHERE d.hash = md5(maillogs.recipient))"
+        ))
+        _template_messages(
+            conn, "SELECT id, message FROM maillogs WHERE id > :after AND message IS NOT NULL ORDER BY id LIMIT :n"
+        )
+        if engine.dialect.name == "postgresql":
+            conn.execute(text("ALTER TABLE maillogs ALTER COLUMN kind_code DROP DEFAULT"))
+        for name in ("kind", "status", "sender", "recipient", "message"):
+            conn.execute(text(f"ALTER TABLE maillogs DROP COLUMN {name}"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_maillogs_sender_id ON maillogs (sender_id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_maillogs_recipient_id ON maillogs (recipient_id)"))
+    _vacuum(engine, "maillogs")
+    logger.info(format_report(before, table_sizes(engine)))
+
+def template_interned_messages(engine: Engine):
+    """Convert tables whose mail_messages held whole messages (message_text_id) to templates."""
+    if "message_text_id" not in _columns(engine, "maillogs"):
+        return
+    logger.info("migration: splitting interned maillogs messages into templates")
+    before = table_sizes(engine)
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE maillogs RENAME COLUMN message_text_id TO message_template_id"))
+        conn.execute(text("ALTER TABLE maillogs ADD COLUMN message_params TEXT"))
+        _template_messages(
+            conn,
+            "SELECT l.id, d.value FROM maillogs l JOIN mail_messages d ON d.id = l.message_template_id "
+            "WHERE l.id > :after ORDER BY l.id LIMIT :n",
+        )
+        # Whole messages nobody points at any more; templates without
+        # parameters are the message itself and stay referenced
+        conn.execute(text(
+            "DELETE FROM mail_messages WHERE id NOT IN "
+            "(SELECT message_template_id FROM maillogs WHERE message_template_id IS NOT NULL)"
+        ))
+    _vacuum(engine, "maillogs", "mail_messages")
+    logger.info(format_report(before, table_sizes(engine)))
+
+def fill_null_kind_codes(engine: Engine):
+    """Repair tables encoded before unknown kinds mapped to "other" (kind_code NULL)."""
+    if "kind_code" not in _columns(engine, "maillogs"):
+        return
+    column = next(c for c in inspect(engine).get_columns("maillogs") if c["name"] == "kind_code")
+    if not column["nullable"]:
+        return
+    with engine.begin() as conn:
+        fixed = conn.execute(text(f"UPDATE maillogs SET kind_code = {MAIL_KIND_OTHER} WHERE kind_code IS NULL")).rowcount
+        # SQLite cannot add NOT NULL to an existing column; the model still
+        # enforces it for new rows
+        if engine.dialect.name == "postgresql":
+            conn.execute(text("ALTER TABLE maillogs ALTER COLUMN kind_code SET NOT NULL"))
+    if fixed:
+        logger.info("migration: %d maillogs rows with unknown kind set to other", fixed)
+
+# Applied in order after create_all; each step must be idempotent
+MIGRATIONS = [
+    add_maillog_event_id,
+    scope_event_id_per_server,
+    encode_maillog_columns,
+    fill_null_kind_codes,
+    template_interned_messages,
+]
+
+def run_migrations(engine: Engine):
+    for step in MIGRATIONS:
+        step(engine)
+
+def prepare_database(engine: Engine):
+    """Create missing tables and apply migrations; safe to call on every boot."""
+    Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
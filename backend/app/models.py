@@ -1,7 +1,28 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, SmallInteger, String, DateTime, ForeignKey, Index, Text
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator
 from .db import Base
+from .messages import join_message
+
+# MailLog.kind is stored as a small integer; codes must never be reused.
+# "other" holds legacy rows whose kind was none of the known logs.
+MAIL_KIND_OTHER = 0
+MAIL_KINDS = {"other": MAIL_KIND_OTHER, "mainlog": 1, "rejectlog": 2, "paniclog": 3}
+MAIL_KIND_NAMES = {code: name for name, code in MAIL_KINDS.items()}
+
+class MailKind(TypeDecorator):
+    """Kind name on the Python side, SmallInteger code in the database."""
+    impl = SmallInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return MAIL_KINDS[value]
+
+    def process_result_value(self, value, dialect):
+        return MAIL_KIND_NAMES.get(value)
 
 class Server(Base):
     __tablename__ = "servers"
@@ -11,18 +32,62 @@ class Server(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     logs = relationship("MailLog", back_populates="server")
 
+class InternedValue:
+    """Dictionary table: each distinct value stored once, looked up by its md5."""
+    id = Column(Integer, primary_key=True)
+    hash = Column(String(32), unique=True, nullable=False)
+    value = Column(Text, nullable=False)
+
+class MailStatus(InternedValue, Base):
+    __tablename__ = "mail_statuses"
+
+class MailAddress(InternedValue, Base):
+    __tablename__ = "mail_addresses"
+
+class MailTemplate(InternedValue, Base):
+    """Message wording with its variable parts cut out (see messages.py)."""
+    __tablename__ = "mail_messages"
+
 class MailLog(Base):
     __tablename__ = "maillogs"
+    __table_args__ = (Index("ux_maillogs_server_event", "server_id", "event_id", unique=True),)
     id = Column(Integer, primary_key=True, index=True)
     server_id = Column(Integer, ForeignKey("servers.id"), nullable=False)
-    kind = Column(String(20), nullable=False)
-    sender = Column(String(255))
-    recipient = Column(String(255))
-    status = Column(String(50))
-    message = Column(Text)
+    # Deterministic id derived by the agent, unique per server; duplicates are
+    # ignored on ingest
+    event_id = Column(String(64))
+    kind = Column("kind_code", MailKind, nullable=False)
+    # Repetitive values are interned in dictionary tables (see dictionary.py)
+    status_id = Column(Integer, ForeignKey("mail_statuses.id"))
+    sender_id = Column(Integer, ForeignKey("mail_addresses.id"), index=True)
+    recipient_id = Column(Integer, ForeignKey("mail_addresses.id"), index=True)
+    message_template_id = Column(Integer, ForeignKey("mail_messages.id"))
+    message_params = Column(Text)
     message_id = Column(String(255))
     timestamp = Column(DateTime, default=datetime.utcnow, index=True)
     server = relationship("Server", back_populates="logs")
+    status_ref = relationship(MailStatus, lazy="joined")
+    sender_ref = relationship(MailAddress, foreign_keys=[sender_id], lazy="joined")
+    recipient_ref = relationship(MailAddress, foreign_keys=[recipient_id], lazy="joined")
+    message_template = relationship(MailTemplate, lazy="joined")
+
+    # Read-side accessors keep the original row shape for schemas and callers
+    @property
+    def status(self):
+        return self.status_ref.value if self.status_ref else None
+
+    @property
+    def sender(self):
+        return self.sender_ref.value if self.sender_ref else None
+
+    @property
+    def recipient(self):
+        return self.recipient_ref.value if self.recipient_ref else None
+
+    @property
+    def message(self):
+        template = self.message_template.value if self.message_template else None
+        return join_message(template, self.message_params)
 
 class User(Base):
     __tablename__ = "users"
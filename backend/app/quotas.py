@@ -0,0 +1,94 @@
+import hashlib
+import os
+import tempfile
+import time
+from .localstore import LocalStore
+
+# Per-API-key ingest quotas, counted in events and bytes rather than requests.
+# Rates <= 0 disable the corresponding bucket.
+INGEST_EVENTS_PER_SECOND = float(os.getenv("INGEST_EVENTS_PER_SECOND", "200"))
+INGEST_BYTES_PER_SECOND = float(os.getenv("INGEST_BYTES_PER_SECOND", str(512 * 1024)))
+# Bucket capacity, expressed as seconds of sustained rate
+INGEST_BURST_SECONDS = float(os.getenv("INGEST_BURST_SECONDS", "10"))
+QUOTA_STATE_PATH = os.getenv("QUOTA_STATE_PATH", os.path.join(tempfile.gettempdir(), "mailmon-quotas.db"))
+
+class TokenBucketStore:
+    """Token buckets kept in a local SQLite file, shared by every worker process on the host.
+
+    Each consume() is one LocalStore transaction, so refills and deductions
+    from concurrent workers are serialized on the file lock.
+    """
+
+    def __init__(self, path: str, events_rate: float, bytes_rate: float, burst_seconds: float):
+        self.events_rate = events_rate
+        self.bytes_rate = bytes_rate
+        self.events_capacity = events_rate * burst_seconds
+        self.bytes_capacity = bytes_rate * burst_seconds
+        self.store = LocalStore(
+            path,
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "key TEXT PRIMARY KEY, events REAL NOT NULL, bytes REAL NOT NULL, updated REAL NOT NULL)",
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.events_rate > 0 or self.bytes_rate > 0
+
+    @staticmethod
+    def _bucket(key: str) -> str:
+        # Never store the API key itself in the shared file
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def consume(self, key: str, events: int, nbytes: int) -> float:
+        """Take tokens for one request; return 0 if admitted, else seconds until it would be."""
+        if not self.enabled:
+            return 0.0
+        cost_e = events if self.events_rate > 0 else 0
+        cost_b = nbytes if self.bytes_rate > 0 else 0
+        bucket = self._bucket(key)
+        now = time.time()
+        with self.store.transaction() as conn:
+            row = conn.execute("SELECT events, bytes, updated FROM buckets WHERE key = ?", (bucket,)).fetchone()
+            if row:
+                elapsed = max(0.0, now - row[2])
+                tokens_e = min(self.events_capacity, row[0] + elapsed * self.events_rate)
+                tokens_b = min(self.bytes_capacity, row[1] + elapsed * self.bytes_rate)
+            else:
+                tokens_e, tokens_b = self.events_capacity, self.bytes_capacity
+            # A request larger than the bucket is admitted once the bucket is
+            # full, instead of being rejected forever, but is still charged in
+            # full: the bucket goes into debt and the long-run rate holds
+            need_e = min(cost_e, self.events_capacity)
+            need_b = min(cost_b, self.bytes_capacity)
+            wait = 0.0
+            if need_e > tokens_e:
+                wait = max(wait, (need_e - tokens_e) / self.events_rate)
+            if need_b > tokens_b:
+                wait = max(wait, (need_b - tokens_b) / self.bytes_rate)
+            if wait == 0.0:
+                tokens_e -= cost_e
+                tokens_b -= cost_b
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (key, events, bytes, updated) VALUES (?, ?, ?, ?)",
+                (bucket, tokens_e, tokens_b, now),
+            )
+        return wait
+
+    def refund(self, key: str, events: int, nbytes: int):
+        """Give back tokens a consume() charged for work that turned out unnecessary."""
+        if not self.enabled or (events <= 0 and nbytes <= 0):
+            return
+        refund_e = events if self.events_rate > 0 else 0
+        refund_b = nbytes if self.bytes_rate > 0 else 0
+        with self.store.transaction() as conn:
+            conn.execute(
+                "UPDATE buckets SET events = MIN(?, events + ?), bytes = MIN(?, bytes + ?) WHERE key = ?",
+                (self.events_capacity, refund_e, self.bytes_capacity, refund_b, self._bucket(key)),
+            )
+
+ingest_quota = TokenBucketStore(
+    QUOTA_STATE_PATH,
+    INGEST_EVENTS_PER_SECOND,
+    INGEST_BYTES_PER_SECOND,
+    INGEST_BURST_SECONDS,
+)
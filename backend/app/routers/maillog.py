@@ -1,33 +1,95 @@
+import math
 from datetime import datetime, timedelta
 from typing import List, Optional
-from fastapi import APIRouter, Depends, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from sqlalchemy.orm import Session
 from sqlalchemy import func, case
-from ..db import get_db
-from ..models import MailLog, Server
-from ..schemas import MailLogIn, MailLogOut
-from ..deps import api_key_checker
+from ..db import dialect_insert, get_db
+from ..models import MAIL_KINDS, MailLog, Server
+from ..schemas import IngestResult, MailLogIn, MailLogOut
+from ..deps import api_key_checker, server_cache
+from ..limits import limiter
+from ..messages import split_message
+from ..metrics import INGEST_ROWS
+from ..quotas import ingest_quota
+from .. import dictionary
 
 router = APIRouter(prefix="/maillog", tags=["maillog"])
 
-@router.post("")
-def ingest(logs: List[MailLogIn], server: Server = Depends(api_key_checker), db: Session = Depends(get_db)):
-    items = []
-    for l in logs:
-        ml = MailLog(
-            server_id=server.id,
-            kind=l.kind,
-            timestamp=l.timestamp,
-            sender=l.sender,
-            recipient=l.recipient,
-            status=l.status,
-            message=l.message,
-            message_id=l.message_id,
+# Rows per INSERT statement, keeps bound parameters well under driver limits
+INGEST_CHUNK = 1000
+
+def _insert_ignoring_duplicates(db: Session, rows: List[dict]) -> int:
+    """Bulk INSERT ... ON CONFLICT (server_id, event_id) DO NOTHING; returns rows inserted."""
+    insert = dialect_insert(db)
+    inserted = 0
+    for i in range(0, len(rows), INGEST_CHUNK):
+        stmt = (
+            insert(MailLog)
+            .values(rows[i:i + INGEST_CHUNK])
+            .on_conflict_do_nothing(index_elements=["server_id", "event_id"])
+            .returning(MailLog.id)
         )
-        items.append(ml)
-    db.add_all(items)
+        inserted += len(db.execute(stmt).all())
+    return inserted
+
+async def _body_size(request: Request) -> int:
+    # Measured rather than taken from Content-Length, which chunked uploads
+    # do not send; FastAPI has already read and cached the body
+    return len(await request.body())
+
+@router.post("", response_model=IngestResult)
+@limiter.exempt  # throttled by the per-key ingest quota instead of the per-IP limit
+def ingest(
+    logs: List[MailLogIn],
+    response: Response,
+    nbytes: int = Depends(_body_size),
+    server: Server = Depends(api_key_checker),
+    db: Session = Depends(get_db),
+):
+    quota_headers = {}
+    if ingest_quota.events_rate > 0:
+        # Lets agents size their batches to what the bucket can ever admit
+        quota_headers["X-Quota-Events-Limit"] = str(int(ingest_quota.events_capacity))
+    wait = ingest_quota.consume(server.api_key, len(logs), nbytes)
+    if wait > 0:
+        raise HTTPException(
+            status_code=429,
+            detail="Ingest quota exceeded",
+            headers={"Retry-After": str(max(1, math.ceil(wait))), **quota_headers},
+        )
+    response.headers.update(quota_headers)
+    status_ids = dictionary.statuses.resolve(db, (l.status for l in logs))
+    address_ids = dictionary.addresses.resolve(db, [l.sender for l in logs] + [l.recipient for l in logs])
+    messages = [split_message(l.message) for l in logs]
+    template_ids = dictionary.templates.resolve(db, (template for template, _ in messages))
+    rows = [
+        {
+            "server_id": server.id,
+            "event_id": l.event_id,
+            "kind": l.kind,
+            "timestamp": l.timestamp,
+            "status_id": status_ids.get(l.status),
+            "sender_id": address_ids.get(l.sender),
+            "recipient_id": address_ids.get(l.recipient),
+            "message_template_id": template_ids.get(template),
+            "message_params": params,
+            "message_id": l.message_id,
+        }
+        for l, (template, params) in zip(logs, messages)
+    ]
+    if not rows:
+        return IngestResult(ingested=0, duplicates=0)
+    inserted = _insert_ignoring_duplicates(db, rows)
     db.commit()
-    return {"ingested": len(items)}
+    duplicates = len(rows) - inserted
+    if duplicates:
+        # Only stored events count against the quota, so re-sends after an
+        # agent rollback do not eat the window the backlog needs
+        ingest_quota.refund(server.api_key, duplicates, nbytes * duplicates // len(rows))
+    INGEST_ROWS.labels("inserted").inc(inserted)
+    INGEST_ROWS.labels("duplicate").inc(duplicates)
+    return IngestResult(ingested=inserted, duplicates=duplicates)
 
 @router.get("", response_model=List[MailLogOut])
 def list_logs(
@@ -43,13 +105,25 @@ def list_logs(
 ):
     q = db.query(MailLog)
     if server:
-        q = q.join(Server).filter(Server.name == server)
+        s = server_cache.by_name(db, server)
+        if s is None:
+            return []
+        q = q.filter(MailLog.server_id == s.id)
     if email:
-        q = q.filter((MailLog.sender == email) | (MailLog.recipient == email))
+        # Unknown values have no dictionary id, so nothing can match them
+        address_id = dictionary.addresses.lookup(db, email)
+        if address_id is None:
+            return []
+        q = q.filter((MailLog.sender_id == address_id) | (MailLog.recipient_id == address_id))
     if kind:
+        if kind not in MAIL_KINDS:
+            return []
         q = q.filter(MailLog.kind == kind)
     if status:
-        q = q.filter(MailLog.status == status)
+        status_id = dictionary.statuses.lookup(db, status)
+        if status_id is None:
+            return []
+        q = q.filter(MailLog.status_id == status_id)
     if date_from:
         q = q.filter(MailLog.timestamp >= date_from)
     if date_to:
@@ -2,6 +2,7 @@ import secrets
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from ..db import get_db
+from ..deps import server_cache
 from ..models import Server, MailLog
 from ..schemas import ServerCreate, ServerOut
 
@@ -41,4 +42,6 @@ def delete_server(server_id: int, db: Session = Depends(get_db)):
     db.query(MailLog).filter(MailLog.server_id == s.id).delete()
     db.delete(s)
     db.commit()
+    # Every worker on the host drops it on its next lookup
+    server_cache.invalidate()
     return {"detail": "deleted"}
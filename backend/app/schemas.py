@@ -1,6 +1,6 @@
 from datetime import datetime
-from typing import Optional, List
-from pydantic import BaseModel
+from typing import Literal, Optional, List
+from pydantic import BaseModel, Field
 
 class AuthRequest(BaseModel):
     email: str
@@ -22,8 +22,9 @@ class ServerOut(BaseModel):
         from_attributes = True
 
 class MailLogIn(BaseModel):
+    event_id: Optional[str] = Field(None, max_length=64)
     server_name: str
-    kind: str
+    kind: Literal["mainlog", "rejectlog", "paniclog"]
     timestamp: datetime
     sender: Optional[str] = None
     recipient: Optional[str] = None
@@ -31,6 +32,10 @@ class MailLogIn(BaseModel):
     message: Optional[str] = None
     message_id: Optional[str] = None
 
+class IngestResult(BaseModel):
+    ingested: int
+    duplicates: int
+
 class MailLogQuery(BaseModel):
     server: Optional[str] = None
     email: Optional[str] = None
@@ -42,6 +47,7 @@ class MailLogQuery(BaseModel):
 class MailLogOut(BaseModel):
     id: int
     server_id: int
+    event_id: Optional[str]
     kind: str
     sender: Optional[str]
     recipient: Optional[str]
@@ -0,0 +1,77 @@
+"""Production launcher: python -m app.serve
+
+Prepares the schema and warms lookups once in the master, preloads the app
+so workers share its memory copy-on-write, then forks WEB_CONCURRENCY
+uvicorn workers under gunicorn. Worker-shared state lives in local files:
+Prometheus multiprocess metrics, ingest quotas and the SlowAPI counters.
+"""
+import glob
+import logging
+import multiprocessing
+import os
+import tempfile
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WORKERS = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+
+logger = logging.getLogger(__name__)
+
+def _prepare_env():
+    # Has to happen before prometheus_client or the limiter are imported
+    metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "mailmon-metrics"))
+    # The directory is often a volume or tmpfs mount: keep it, but remove the
+    # previous run's files, which would be summed into the new counters
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+        os.remove(path)
+    os.environ.setdefault(
+        "RATE_LIMIT_STORAGE_URI",
+        "sqlite:///" + os.path.join(tempfile.gettempdir(), "mailmon-ratelimit.db"),
+    )
+    # Tells the app's startup hook that the master already did its work
+    os.environ["MAILMON_SCHEMA_READY"] = "1"
+
+def _post_fork(server, worker):
+    from .db import engine
+    # Never share pooled connections with the master; close=False leaves the
+    # parent's sockets alone
+    engine.dispose(close=False)
+
+def _child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+def main():
+    _prepare_env()
+    from gunicorn.app.base import BaseApplication
+    from .db import SessionLocal, engine
+    from .deps import server_cache
+    from .main import app
+    from .migrations import prepare_database
+
+    prepare_database(engine)
+    with SessionLocal() as db:
+        server_cache.warm(db)
+    engine.dispose()
+    logger.info("schema ready, %d servers cached, starting %d workers", server_cache.stats()["size"], WORKERS)
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in {
+                "bind": f"{HOST}:{PORT}",
+                "workers": WORKERS,
+                "worker_class": "uvicorn.workers.UvicornWorker",
+                "preload_app": True,
+                "post_fork": _post_fork,
+                "child_exit": _child_exit,
+            }.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Application().run()
+
+if __name__ == "__main__":
+    main()
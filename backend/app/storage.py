@@ -0,0 +1,60 @@
+import logging
+from typing import Dict, Optional
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger(__name__)
+
+# maillogs plus the dictionary tables its repetitive columns are interned into
+MAILLOG_TABLES = ("maillogs", "mail_statuses", "mail_addresses", "mail_messages")
+
+def table_sizes(engine: Engine) -> Optional[Dict[str, int]]:
+    """On-disk bytes (heap + indexes) of each existing maillog table, or None if unsupported."""
+    existing = [t for t in MAILLOG_TABLES if t in inspect(engine).get_table_names()]
+    with engine.connect() as conn:
+        if engine.dialect.name == "postgresql":
+            return {t: conn.execute(text("SELECT pg_total_relation_size(:t)"), {"t": t}).scalar() for t in existing}
+        if engine.dialect.name == "sqlite":
+            try:
+                rows = conn.execute(text(
+                    "SELECT m.tbl_name, SUM(s.pgsize) FROM dbstat s "
+                    "JOIN sqlite_master m ON m.name = s.name GROUP BY m.tbl_name"
+                )).all()
+            except OperationalError:
+                # SQLite built without the dbstat virtual table
+                return None
+            sizes = dict(rows)
+            return {t: int(sizes.get(t) or 0) for t in existing}
+    return None
+
+def _mb(n: int) -> str:
+    return f"{n / (1024 * 1024):.1f} MB"
+
+def format_report(before: Optional[Dict[str, int]], after: Optional[Dict[str, int]]) -> str:
+    if before is None or after is None:
+        return "storage report: table sizes not available for this database"
+    lines = ["storage report (table + indexes):"]
+    for t in MAILLOG_TABLES:
+        if t in before or t in after:
+            lines.append(f"  {t}: {_mb(before.get(t, 0))} -> {_mb(after.get(t, 0))}")
+    total_before = sum(before.values())
+    total_after = sum(after.values())
+    change = 100.0 * abs(total_after - total_before) / total_before if total_before else 0.0
+    direction = "larger" if total_after > total_before else "smaller"
+    lines.append(f"  total: {_mb(total_before)} -> {_mb(total_after)} ({change:.0f}% {direction})")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    # python -m app.storage: current sizes and bytes per log row
+    from .db import engine
+    sizes = table_sizes(engine)
+    if sizes is None:
+        print("table sizes not available for this database")
+    else:
+        with engine.connect() as conn:
+            rows = conn.execute(text("SELECT COUNT(*) FROM maillogs")).scalar() if "maillogs" in sizes else 0
+        for t, n in sizes.items():
+            print(f"{t}: {_mb(n)}")
+        total = sum(sizes.values())
+        print(f"total: {_mb(total)}, {rows} log rows, {total / rows if rows else 0:.0f} bytes/row")